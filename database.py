@@ -1,20 +1,204 @@
-from typing import Annotated
+import os
+from asyncio import current_task
+from time import monotonic
+from typing import Annotated, Awaitable, Callable, TypeVar
 
 from fastapi import Depends, FastAPI, HTTPException, Query
-from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import (
+    async_scoped_session,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlmodel import Field, SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from schema import Book
 
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
+# SQLITE_DATABASE=:memory: keeps everything in a single in-process connection,
+# which is handy for local experiments; the data is gone when the process exits.
+sqlite_file_name = os.getenv("SQLITE_DATABASE", "database.db")
+sqlite_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
 
 connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
 
+# Compiled SQL is cached per engine and reused across requests. The CRUD routes
+# only produce a few dozen distinct statements (one UPDATE per combination of
+# fields sent), so this keeps all of them compiled with plenty of headroom.
+query_cache_size = 1200
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+# SQLite builds from the begin-concurrent-wal2 branch can run with
+# SQLITE_JOURNAL_MODE=wal2 and SQLITE_BEGIN="BEGIN CONCURRENT", so concurrent
+# writers only conflict when they touch the same pages. Stock SQLite keeps the
+# WAL / deferred BEGIN defaults.
+sqlite_journal_mode = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+sqlite_begin = os.getenv("SQLITE_BEGIN", "BEGIN")
 
+# How long a statement waits for another connection's write lock before failing
+# with SQLITE_BUSY.
+busy_timeout_ms = 5000
 
-def get_session():
-    with Session(engine) as session:
-        yield session
+# SQLITE_BUSY_SNAPSHOT means another writer committed over the snapshot this
+# transaction read (or, under BEGIN CONCURRENT, over the pages it wrote), so it
+# can only succeed by starting again. run_write retries it this many times.
+SQLITE_BUSY_SNAPSHOT = 517
+write_attempts = 5
+
+if sqlite_file_name == ":memory:":
+    # An in-memory database lives and dies with its connection, so every
+    # session has to share a single one. A one-slot queue pool hands it to one
+    # session at a time: concurrent sessions on the same connection would try to
+    # BEGIN inside each other's transactions and commit each other's work.
+    engine = create_async_engine(
+        sqlite_url,
+        echo=False,
+        connect_args=connect_args,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        query_cache_size=query_cache_size,
+    )
+else:
+    engine = create_async_engine(
+        sqlite_url,
+        echo=False,
+        connect_args=connect_args,
+        pool_size=20,
+        max_overflow=10,
+        pool_timeout=30,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+        query_cache_size=query_cache_size,
+    )
+
+# Objects stay loaded after commit so handlers can return them without
+# triggering a lazy refresh outside the session's greenlet.
+async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+# One session per request task. SessionMiddleware closes it once the response
+# has been sent, so get_session does not need a generator and an exit stack.
+scoped_session = async_scoped_session(async_session, scopefunc=current_task)
+
+# Applied once to every new DBAPI connection opened by the engine.
+sqlite_pragmas = (
+    f"PRAGMA journal_mode={sqlite_journal_mode}",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=2147483648",
+    f"PRAGMA busy_timeout={busy_timeout_ms}",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Stop the sqlite3 driver from issuing its own BEGIN; begin_transaction()
+    # below decides how transactions are opened.
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlite_pragmas:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+@event.listens_for(engine.sync_engine, "begin")
+def begin_transaction(connection):
+    connection.exec_driver_sql(sqlite_begin)
+
+
+# Refreshes the planner statistics of tables that have changed enough to need it.
+optimize_pragmas = ("PRAGMA analysis_limit=400", "PRAGMA optimize")
+
+
+@event.listens_for(engine.sync_engine, "close")
+def optimize_on_close(dbapi_connection, connection_record):
+    # SQLite recommends running PRAGMA optimize just before a connection closes.
+    # The pool closes connections when they are recycled, overflow or disposed,
+    # which spreads these runs out over the life of the process. A failure here
+    # must not stop the connection from being closed.
+    try:
+        cursor = dbapi_connection.cursor()
+        for pragma in optimize_pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+    except Exception:
+        pass
+
+
+async def create_db_and_tables():
+    async with engine.begin() as connection:
+        await connection.run_sync(SQLModel.metadata.create_all)
+        # Nothing queries books by name; drop the index older databases carry.
+        await connection.exec_driver_sql("DROP INDEX IF EXISTS ix_book_name")
+
+
+async def warm_up_db():
+    # Opens a pooled connection, which applies the PRAGMAs, and compiles the
+    # lookup get_book runs. Fails at startup if migrate.py has not been run.
+    if sqlite_file_name == ":memory:":
+        # migrate.py runs in its own process and cannot reach this database.
+        await create_db_and_tables()
+    async with async_session() as session:
+        await session.get(Book, 0)
+
+
+async def optimize_db():
+    async with engine.begin() as connection:
+        for pragma in optimize_pragmas:
+            await connection.exec_driver_sql(pragma)
+
+
+def is_busy_snapshot(error: OperationalError) -> bool:
+    code = getattr(error.orig, "sqlite_errorcode", None)
+    if code is None:
+        # Python < 3.11 does not expose extended result codes, and every
+        # SQLITE_BUSY reads "database is locked". run_write's time limit keeps
+        # it from retrying the ones that already waited out busy_timeout.
+        return str(error.orig) == "database is locked"
+    return code == SQLITE_BUSY_SNAPSHOT
+
+
+T = TypeVar("T")
+
+
+async def run_write(session: AsyncSession, write: Callable[[], Awaitable[T]]) -> T:
+    """Runs `write` and commits it, starting over after a snapshot conflict."""
+    # A snapshot conflict fails at once, without waiting on busy_timeout. A write
+    # that has already spent that long failing is stuck behind another writer's
+    # lock, and starting it again would only make the request wait longer.
+    deadline = monotonic() + busy_timeout_ms / 1000
+    attempt = 1
+    while True:
+        try:
+            result = await write()
+            await session.commit()
+            return result
+        except OperationalError as error:
+            if (
+                attempt == write_attempts
+                or not is_busy_snapshot(error)
+                or monotonic() >= deadline
+            ):
+                raise
+            await session.rollback()
+            attempt += 1
+
+
+async def get_session():
+    return scoped_session()
+
+
+class SessionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await scoped_session.remove()
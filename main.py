@@ -1,21 +1,72 @@
-from database import create_db_and_tables, get_session
+from database import (
+    SessionMiddleware,
+    engine,
+    get_session,
+    optimize_db,
+    run_write,
+    sqlite_file_name,
+    warm_up_db,
+)
 from schema import Book
+from contextlib import asynccontextmanager
 from typing import Annotated
+from cachetools import TTLCache
 from fastapi import Depends, FastAPI, HTTPException
-from sqlmodel import Session
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import delete, insert, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+import os
 import uvicorn
 
 
-SessionDep = Annotated[Session, Depends(get_session)]
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
 
+# Recently read books keyed by id. Writes in this process evict their entry;
+# writes made by other workers can be served stale for up to `ttl` seconds.
+book_cache: TTLCache[int, Book] = TTLCache(maxsize=4096, ttl=5)
 
+# Bumped by every eviction. get_book only caches a row if no write has been
+# evicted since it started reading, so a read that raced a PUT or DELETE cannot
+# put the old row back after the write has popped it.
+book_cache_generation = 0
+
+
+def evict_book(book_id: int) -> None:
+    global book_cache_generation
+    book_cache_generation += 1
+    book_cache.pop(book_id, None)
+
+
+# Shared by every route that looks a book up by id. Raise it with
+# `.with_traceback(None)`: re-raising the same instance otherwise appends each
+# request's frames to its traceback and keeps them alive.
+BOOK_NOT_FOUND = HTTPException(status_code=404, detail="book not found")
+
+# The book routes dump their results with dump_book instead of having FastAPI
+# validate them against a response_model on every call; `responses` keeps the
+# Book schema in the OpenAPI docs. Every field is a JSON primitive, so the values
+# are read straight off __dict__, skipping the instrumented attribute access, in
+# declaration order: rows loaded from the database fill __dict__ in whatever
+# order the ORM happens to set them.
+book_fields = tuple(Book.model_fields)
+
+
+def dump_book(book: Book) -> dict[str, int | str | None]:
+    values = book.__dict__
+    return {field: values[field] for field in book_fields}
+
+
+@asynccontextmanager
 async def lifespan(app: FastAPI):
-    create_db_and_tables()
+    # The schema is created by migrate.py at deploy time, not by every worker.
+    await warm_up_db()
     yield
-    pass
+    await optimize_db()
+    await engine.dispose()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(SessionMiddleware)
 
 
 @app.get("/health/liveness", tags=["Health"])
@@ -28,43 +79,103 @@ def readiness_probe():
     return {"status": "ready"}
 
 
-@app.post("/books/")
-def create_book(book: Book, session: SessionDep) -> Book:
-    session.add(book)
-    session.commit()
-    session.refresh(book)
-    return book
-
-
-@app.get("/books/{book_id}")
-def get_book(book_id: int, session: SessionDep) -> Book:
-    book = session.get(Book, book_id)
-    if not book:
-        raise HTTPException(status_code=404, detail="Book not found")
-    return book
-
-
-@app.put("/books/{book_id}")
-def update_book(book_id: int, book: Book, session: SessionDep) -> Book:
-    existing_book = session.get(Book, book_id)
-    if not existing_book:
-        raise HTTPException(status_code=404, detail="book not found")
-    for key, value in book.model_dump().items():
-        setattr(existing_book, key, value)
-    session.commit()
-    session.refresh(existing_book)
-    return existing_book
+@app.post("/books/", response_model=None, responses={200: {"model": Book}})
+async def create_book(book: Book, session: SessionDep) -> ORJSONResponse:
+    statement = (
+        insert(Book).values(**book.model_dump(exclude_unset=True)).returning(Book)
+    )
+    created_book = await run_write(session, lambda: session.scalar(statement))
+    return ORJSONResponse(dump_book(created_book))
+
+
+@app.post("/books/bulk", response_model=None, responses={200: {"model": list[Book]}})
+async def create_books(books: list[Book], session: SessionDep) -> ORJSONResponse:
+    if not books:
+        return ORJSONResponse([])
+    # The parameter sets go out as one multi-row INSERT ... RETURNING and are
+    # committed together. SQLite does not promise to return rows in the order
+    # they were inserted, and asking SQLAlchemy to sort them would split the
+    # batch back into one INSERT per row.
+    statement = insert(Book).returning(Book)
+    params = [book.model_dump(exclude_unset=True) for book in books]
+
+    async def insert_books():
+        result = await session.exec(statement, params=params)
+        return result.scalars().all()
+
+    created_books = await run_write(session, insert_books)
+    return ORJSONResponse([dump_book(book) for book in created_books])
+
+
+@app.get("/books/{book_id}", response_model=None, responses={200: {"model": Book}})
+async def get_book(book_id: int, session: SessionDep) -> ORJSONResponse:
+    book = book_cache.get(book_id)
+    if book is None:
+        generation = book_cache_generation
+        book = await session.get(Book, book_id)
+        if not book:
+            raise BOOK_NOT_FOUND.with_traceback(None)
+        if generation == book_cache_generation:
+            book_cache[book_id] = book
+    return ORJSONResponse(dump_book(book))
+
+
+@app.put("/books/{book_id}", response_model=None, responses={200: {"model": Book}})
+async def update_book(book_id: int, book: Book, session: SessionDep) -> ORJSONResponse:
+    # Only the fields the client actually sent; reading them off the instance
+    # skips a full model_dump() walk through the serializer.
+    values = {
+        field: book.__dict__[field] for field in book.model_fields_set if field != "id"
+    }
+    if not values:
+        # Nothing to change: an UPDATE with an empty SET clause is not valid SQL.
+        current_book = await session.get(Book, book_id)
+        if not current_book:
+            raise BOOK_NOT_FOUND.with_traceback(None)
+        return ORJSONResponse(dump_book(current_book))
+    statement = (
+        update(Book)
+        .where(Book.id == book_id)
+        .values(**values)
+        .returning(Book)
+        .execution_options(synchronize_session=False)
+    )
+    updated_book = await run_write(session, lambda: session.scalar(statement))
+    if not updated_book:
+        raise BOOK_NOT_FOUND.with_traceback(None)
+    evict_book(book_id)
+    return ORJSONResponse(dump_book(updated_book))
 
 
 @app.delete("/books/{book_id}")
-def delete_book(book_id: int, session: SessionDep) -> Book:
-    book = session.get(Book, book_id)
-    if not book:
-        raise HTTPException(status_code=404, detail="book not found")
-    session.delete(book)
-    session.commit()
+async def delete_book(book_id: int, session: SessionDep) -> dict[str, str]:
+    statement = (
+        delete(Book)
+        .where(Book.id == book_id)
+        .returning(Book.id)
+        .execution_options(synchronize_session=False)
+    )
+    deleted_id = await run_write(session, lambda: session.scalar(statement))
+    if deleted_id is None:
+        raise BOOK_NOT_FOUND.with_traceback(None)
+    evict_book(book_id)
     return {"detail": "book deleted"}
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker would get its own in-memory database, so a book created on one
+    # would be missing on the others.
+    if sqlite_file_name == ":memory:":
+        workers = 1
+    else:
+        workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        # uvloop and httptools when installed; uvicorn[standard] skips uvloop on
+        # Windows, where "auto" falls back to asyncio.
+        loop="auto",
+        http="auto",
+        workers=workers,
+    )
@@ -0,0 +1,37 @@
+import asyncio
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from database import create_db_and_tables, engine, sqlite_file_name
+
+
+async def migrate():
+    await create_db_and_tables()
+    await engine.dispose()
+
+
+def run_migrations():
+    """
+    Creates the database schema. Run it once per deploy, before starting the
+    application workers:
+
+        python migrate.py
+
+    Creating the schema here instead of in every worker's startup keeps the
+    workers from racing each other for SQLite's write lock on a cold start.
+    The file lock serialises overlapping runs, e.g. two deploys at once. It
+    relies on fcntl, so on Windows runs are not locked against each other.
+    """
+    if fcntl is None:
+        asyncio.run(migrate())
+        return
+    with open(f"{sqlite_file_name}.migrate.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        asyncio.run(migrate())
+
+
+if __name__ == "__main__":
+    run_migrations()
@@ -3,7 +3,7 @@ from sqlmodel import Field, Session, SQLModel, create_engine, select
 
 class Book(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    name: str = Field(index=True)
+    name: str
     author: str
     isbn: int
     price: int
@@ -1,42 +1,101 @@
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+from uuid import uuid4
+
 import pytest
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 # Import the main FastAPI app and the dependency function
-from main import app, get_session
+import database
+from database import (
+    async_session,
+    busy_timeout_ms,
+    run_write,
+    scoped_session,
+    warm_up_db,
+    write_attempts,
+)
+from main import app, book_cache, evict_book, get_book, get_session
 from schema import Book
 
-# Define the connection string for an in-memory SQLite database for testing.
-# This ensures that our tests don't interfere with the actual development database.
-DATABASE_URL = "sqlite:///:memory:"
+# Create a TestClient instance. This client will make requests to the FastAPI app
+# during tests, but without running a live server.
+client = TestClient(app)
 
-# Create the test database engine with connect_args for SQLite compatibility.
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 
+@pytest.fixture(scope="session")
+def template_db():
+    """
+    Builds the schema once, in an in-memory template database.
+    """
+    template = sqlite3.connect(":memory:", check_same_thread=False)
+    template_engine = create_engine(
+        "sqlite://", creator=lambda: template, poolclass=StaticPool
+    )
+    SQLModel.metadata.create_all(template_engine)
+    yield template
+    template.close()
+
+
+@pytest.fixture
+def test_database(template_db):
+    """
+    Gives each test its own in-memory database, copied from the template.
+
+    SQLite's backup API copies the template's pages directly, so no DDL runs per
+    test. The copy is a named, shared-cache in-memory database, which lets the
+    async engine open it by URI. The returned `anchor` connection keeps the copy
+    alive until the test is over, and lets tests change rows behind the app's back.
+    """
+    # Define the connection string for an in-memory SQLite database for testing.
+    # This ensures that our tests don't interfere with the actual development database.
+    database_uri = f"file:test_{uuid4().hex}?mode=memory&cache=shared"
+    anchor = sqlite3.connect(database_uri, uri=True)
+    template_db.backup(anchor)
+    yield database_uri, anchor
+    anchor.close()
 
-# This function will be used as a dependency override.
-# It creates a new database and session for each test, ensuring test isolation.
-def get_test_session():
-    # Create all tables in the in-memory database.
-    SQLModel.metadata.create_all(engine)
-    with Session(engine) as session:
-        try:
-            # Yield the session to the test function.
+
+@pytest.fixture
+def test_engine(test_database):
+    database_uri, _ = test_database
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{database_uri}&uri=true",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    yield engine
+    asyncio.run(engine.dispose())
+
+
+@pytest.fixture(autouse=True)
+def session_override(test_engine):
+    async def get_test_session():
+        async with AsyncSession(test_engine, expire_on_commit=False) as session:
             yield session
-        finally:
-            # After the test is complete, close the session.
-            session.close()
-            # Drop all tables to leave the database clean for the next test.
-            SQLModel.metadata.drop_all(engine)
 
+    # Override the original get_session dependency with our new test session dependency.
+    # This is a core concept of testing FastAPI applications with dependencies.
+    app.dependency_overrides[get_session] = get_test_session
+    yield
+    app.dependency_overrides.pop(get_session, None)
 
-# Override the original get_session dependency with our new test session dependency.
-# This is a core concept of testing FastAPI applications with dependencies.
-app.dependency_overrides[get_session] = get_test_session
 
-# Create a TestClient instance. This client will make requests to the FastAPI app
-# during tests, but without running a live server.
-client = TestClient(app)
+@pytest.fixture(autouse=True)
+def clear_book_cache():
+    # Every test starts from an empty database, so ids get reused between tests.
+    # Clear the read cache to keep one test's books from leaking into the next.
+    book_cache.clear()
 
 
 def test_health_liveness_probe():
@@ -79,6 +138,42 @@ def test_create_book():
     assert data["id"] is not None
 
 
+def test_create_books_bulk():
+    """
+    Tests creating several books in one request via the POST /books/bulk endpoint.
+    """
+    books_data = [
+        {
+            "name": "Foundation",
+            "author": "Isaac Asimov",
+            "isbn": 9780553293357,
+            "price": 8,
+            "pages": 255,
+            "language": "English",
+        },
+        {
+            "name": "Solaris",
+            "author": "Stanislaw Lem",
+            "isbn": 9780156027601,
+            "price": 14,
+            "pages": 204,
+            "language": "Polish",
+        },
+    ]
+    response = client.post("/books/bulk", json=books_data)
+    assert response.status_code == 200
+    data = response.json()
+    # Every book comes back with its new ID.
+    assert sorted(book["name"] for book in data) == ["Foundation", "Solaris"]
+    assert all(book["id"] is not None for book in data)
+
+    # Verify the books were actually stored.
+    for book in data:
+        response = client.get(f"/books/{book['id']}")
+        assert response.status_code == 200
+        assert response.json() == book
+
+
 def test_get_book():
     """
     Tests retrieving a single book by its ID.
@@ -103,13 +198,89 @@ def test_get_book():
     assert data["id"] == book_id
 
 
+def test_book_keys_in_schema_order():
+    """
+    Tests that every route returns a book's fields in the order the schema declares them.
+    """
+    schema_order = ["id", "name", "author", "isbn", "price", "pages", "language"]
+    book_data = {
+        "language": "English",
+        "pages": 250,
+        "price": 10,
+        "isbn": 9780156012195,
+        "author": "Antoine de Saint-Exupery",
+        "name": "The Little Prince",
+    }
+    created = client.post("/books/", json=book_data).json()
+    assert list(created) == schema_order
+    bulk = client.post("/books/bulk", json=[book_data]).json()
+    assert list(bulk[0]) == schema_order
+
+    # Read back from the database, not from the cache.
+    book_cache.clear()
+    assert list(client.get(f"/books/{created['id']}").json()) == schema_order
+    updated = client.put(f"/books/{created['id']}", json={"price": 12}).json()
+    assert list(updated) == schema_order
+
+
 def test_get_book_not_found():
     """
     Tests that a 404 Not Found error is returned when requesting a non-existent book.
     """
     response = client.get("/books/999")
     assert response.status_code == 404
-    assert response.json() == {"detail": "Book not found"}
+    assert response.json() == {"detail": "book not found"}
+
+
+def test_get_book_served_from_cache(test_database):
+    """
+    Tests that a repeated read is answered from the cache, not the database.
+    """
+    book_data = {
+        "name": "Neuromancer",
+        "author": "W. Gibson",
+        "isbn": 9780441569595,
+        "price": 9,
+        "pages": 271,
+        "language": "English",
+    }
+    book_id = client.post("/books/", json=book_data).json()["id"]
+    assert client.get(f"/books/{book_id}").json()["author"] == "W. Gibson"
+
+    # Change the row without going through the API, so nothing evicts it.
+    _, anchor = test_database
+    anchor.execute("UPDATE book SET author = 'William Gibson' WHERE id = ?", (book_id,))
+    anchor.commit()
+
+    assert client.get(f"/books/{book_id}").json()["author"] == "W. Gibson"
+    book_cache.clear()
+    assert client.get(f"/books/{book_id}").json()["author"] == "William Gibson"
+
+
+def test_get_book_racing_a_write_is_not_cached():
+    """
+    Tests that a read which overlaps an eviction does not cache what it read.
+    """
+    stale_book = Book(
+        id=1,
+        name="Neuromancer",
+        author="W. Gibson",
+        isbn=9780441569595,
+        price=9,
+        pages=271,
+        language="English",
+    )
+
+    class RacingSession:
+        async def get(self, model, book_id):
+            # A PUT for the same book commits and evicts while this read is
+            # still in flight.
+            evict_book(book_id)
+            return stale_book
+
+    response = asyncio.run(get_book(1, RacingSession()))
+    assert response.status_code == 200
+    assert 1 not in book_cache
 
 
 def test_update_book():
@@ -147,6 +318,52 @@ def test_update_book():
     )  # Ensure other fields are unchanged
 
 
+def test_update_book_single_field():
+    """
+    Tests that a partial update only changes the field that was sent.
+    """
+    book_data = {
+        "name": "Dune",
+        "author": "Frank Herbert",
+        "isbn": 9780441172719,
+        "price": 10,
+        "pages": 412,
+        "language": "English",
+    }
+    book_id = client.post("/books/", json=book_data).json()["id"]
+
+    response = client.put(f"/books/{book_id}", json={"price": 12})
+    assert response.status_code == 200
+    assert response.json() == {**book_data, "id": book_id, "price": 12}
+
+
+def test_update_book_empty_body():
+    """
+    Tests that an update with no fields returns the book unchanged.
+    """
+    book_data = {
+        "name": "Emma",
+        "author": "Jane Austen",
+        "isbn": 9780141439587,
+        "price": 8,
+        "pages": 474,
+        "language": "English",
+    }
+    book_id = client.post("/books/", json=book_data).json()["id"]
+
+    response = client.put(f"/books/{book_id}", json={})
+    assert response.status_code == 200
+    assert response.json() == {**book_data, "id": book_id}
+
+    response = client.put(f"/books/{book_id}", json={"id": 12345})
+    assert response.status_code == 200
+    assert response.json() == {**book_data, "id": book_id}
+
+    response = client.put("/books/999", json={})
+    assert response.status_code == 404
+    assert response.json() == {"detail": "book not found"}
+
+
 def test_update_book_not_found():
     """
     Tests that a 404 Not Found error is returned when trying to update a non-existent book.
@@ -164,6 +381,28 @@ def test_update_book_not_found():
     assert response.json() == {"detail": "book not found"}
 
 
+def test_update_book_invalidates_cached_read():
+    """
+    Tests that a read after an update returns the new data, not the cached copy.
+    """
+    book_data = {
+        "name": "Neuromancer",
+        "author": "W. Gibson",
+        "isbn": 9780441569595,
+        "price": 9,
+        "pages": 271,
+        "language": "English",
+    }
+    book_id = client.post("/books/", json=book_data).json()["id"]
+    assert client.get(f"/books/{book_id}").json()["author"] == "W. Gibson"
+
+    client.put(f"/books/{book_id}", json={**book_data, "author": "William Gibson"})
+
+    response = client.get(f"/books/{book_id}")
+    assert response.status_code == 200
+    assert response.json()["author"] == "William Gibson"
+
+
 def test_delete_book():
     """
     Tests successfully deleting a book.
@@ -197,3 +436,278 @@ def test_delete_book_not_found():
     response = client.delete("/books/999")
     assert response.status_code == 404
     assert response.json() == {"detail": "book not found"}
+
+
+def test_request_scoped_session_is_released(monkeypatch, test_engine):
+    """
+    Tests the real get_session and SessionMiddleware, without the test override.
+
+    Every request's session must be removed from the registry and its connection
+    returned to the pool, including when the route raises a 404.
+    """
+    monkeypatch.delitem(app.dependency_overrides, get_session)
+    monkeypatch.setitem(async_session.kw, "bind", test_engine)
+    pool_events = {"checkout": 0, "checkin": 0}
+
+    @event.listens_for(test_engine.sync_engine, "checkout")
+    def on_checkout(*args):
+        pool_events["checkout"] += 1
+
+    @event.listens_for(test_engine.sync_engine, "checkin")
+    def on_checkin(*args):
+        pool_events["checkin"] += 1
+
+    book_data = {
+        "name": "Snow Crash",
+        "author": "Neal Stephenson",
+        "isbn": 9780553380958,
+        "price": 11,
+        "pages": 480,
+        "language": "English",
+    }
+    book_id = client.post("/books/", json=book_data).json()["id"]
+    assert client.get(f"/books/{book_id}").status_code == 200
+    assert client.get("/books/999").status_code == 404
+
+    assert scoped_session.registry.registry == {}
+    assert pool_events["checkout"] == 3
+    assert pool_events["checkin"] == pool_events["checkout"]
+
+
+def test_migrate_creates_schema(tmp_path):
+    """
+    Tests that migrate.py creates the book table in the configured database.
+    """
+    database_file = tmp_path / "books.db"
+    subprocess.run(
+        [sys.executable, str(Path(__file__).with_name("migrate.py"))],
+        cwd=tmp_path,
+        env={**os.environ, "SQLITE_DATABASE": str(database_file)},
+        check=True,
+        timeout=60,
+    )
+    with sqlite3.connect(database_file) as connection:
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(book)")]
+    assert columns == ["id", "name", "author", "isbn", "price", "pages", "language"]
+
+
+def test_warm_up_db(monkeypatch, test_engine):
+    """
+    Tests that the startup warm-up succeeds once the schema exists, and fails
+    loudly when migrate.py has not been run.
+    """
+    monkeypatch.setitem(async_session.kw, "bind", test_engine)
+    asyncio.run(warm_up_db())
+
+    empty_engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    monkeypatch.setitem(async_session.kw, "bind", empty_engine)
+    with pytest.raises(OperationalError, match="no such table"):
+        asyncio.run(warm_up_db())
+    asyncio.run(empty_engine.dispose())
+
+
+# Sends overlapping writes through the app's own engine, with the lifespan
+# running, and prints how many of them succeeded.
+CONCURRENT_WRITES = """
+import asyncio
+
+import httpx
+
+from main import app, lifespan
+
+
+async def main():
+    book = {"name": "a", "author": "b", "isbn": 1, "price": 1, "pages": 1, "language": "en"}
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            posts = await asyncio.gather(
+                *(client.post("/books/", json=book) for _ in range(30))
+            )
+            puts = await asyncio.gather(
+                *(client.put("/books/1", json={"price": price}) for price in range(30))
+            )
+    ok = [response.status_code == 200 for response in posts + puts]
+    print(sum(ok))
+
+
+asyncio.run(main())
+"""
+
+
+@pytest.mark.parametrize("database", [":memory:", "books.db"])
+def test_concurrent_writes(tmp_path, database):
+    """
+    Tests that overlapping writes all succeed on the production engine, for both
+    an in-memory and a file database.
+    """
+    repo = Path(__file__).parent
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(repo),
+        "SQLITE_DATABASE": database,
+    }
+    if database != ":memory:":
+        subprocess.run(
+            [sys.executable, str(repo / "migrate.py")],
+            cwd=tmp_path,
+            env=env,
+            check=True,
+            timeout=60,
+        )
+    result = subprocess.run(
+        [sys.executable, "-c", CONCURRENT_WRITES],
+        cwd=tmp_path,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "60"
+
+
+class RecordingSession:
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+
+    async def commit(self):
+        self.commits += 1
+
+    async def rollback(self):
+        self.rollbacks += 1
+
+
+def failing_write(errors):
+    """
+    Returns a write that raises each of `errors` in turn, then succeeds.
+    """
+    errors = iter(errors)
+
+    async def write():
+        error = next(errors, None)
+        if error is not None:
+            raise OperationalError("INSERT INTO book ...", {}, error)
+        return "written"
+
+    return write
+
+
+def sqlite_error(message, code=None):
+    """
+    Builds the sqlite3 error SQLite would raise. Python 3.11+ attaches the
+    extended result code; 3.10 only has the message.
+    """
+    error = sqlite3.OperationalError(message)
+    if code is not None:
+        error.sqlite_errorcode = code
+    return error
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        sqlite_error("database is locked", code=517),
+        sqlite_error("database is locked"),
+    ],
+    ids=["SQLITE_BUSY_SNAPSHOT", "no extended code"],
+)
+def test_run_write_retries_snapshot_conflict(error):
+    """
+    Tests that a write which loses a snapshot conflict is rolled back and re-run.
+    """
+    session = RecordingSession()
+    assert asyncio.run(run_write(session, failing_write([error]))) == "written"
+    assert session.rollbacks == 1
+    assert session.commits == 1
+
+
+def test_run_write_gives_up(monkeypatch):
+    """
+    Tests that retries are bounded and that other errors are not retried.
+    """
+    session = RecordingSession()
+    busy = [sqlite_error("database is locked", code=517)] * write_attempts
+    with pytest.raises(OperationalError):
+        asyncio.run(run_write(session, failing_write(busy)))
+    assert session.rollbacks == write_attempts - 1
+    assert session.commits == 0
+
+    # Plain SQLITE_BUSY has already waited out busy_timeout; so has any error
+    # that arrives after the retry deadline.
+    for error in [
+        sqlite_error("database is locked", code=5),
+        sqlite_error("no such table: book", code=1),
+        sqlite_error("no such table: book"),
+    ]:
+        session = RecordingSession()
+        with pytest.raises(OperationalError):
+            asyncio.run(run_write(session, failing_write([error])))
+        assert session.rollbacks == 0
+
+    clock = iter([0.0, busy_timeout_ms / 1000])
+    monkeypatch.setattr(database, "monotonic", lambda: next(clock))
+    session = RecordingSession()
+    late = [sqlite_error("database is locked")]
+    with pytest.raises(OperationalError):
+        asyncio.run(run_write(session, failing_write(late)))
+    assert session.rollbacks == 0
+
+
+# Makes one session's write lose a snapshot conflict on the app's own engine:
+# it reads, another session commits a write, and only then does it write.
+SNAPSHOT_CONFLICT = """
+import asyncio
+
+from sqlalchemy import func, insert, select
+
+from database import async_session, engine, run_write
+from schema import Book
+
+
+async def main():
+    book = {"name": "a", "author": "b", "isbn": 1, "price": 1, "pages": 1, "language": "en"}
+    attempts = 0
+    async with async_session() as reader, async_session() as writer:
+        await reader.scalar(select(func.count()).select_from(Book))
+        await writer.scalar(insert(Book).values(**book).returning(Book.id))
+        await writer.commit()
+
+        async def write():
+            nonlocal attempts
+            attempts += 1
+            return await reader.scalar(insert(Book).values(**book).returning(Book.id))
+
+        book_id = await run_write(reader, write)
+    await engine.dispose()
+    print(book_id, attempts)
+
+
+asyncio.run(main())
+"""
+
+
+def test_run_write_retries_on_production_engine(tmp_path):
+    """
+    Tests the retry against a real snapshot conflict, through the engine's own
+    connect and begin listeners.
+    """
+    repo = Path(__file__).parent
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(repo),
+        "SQLITE_DATABASE": str(tmp_path / "books.db"),
+    }
+    subprocess.run(
+        [sys.executable, str(repo / "migrate.py")], env=env, check=True, timeout=60
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", SNAPSHOT_CONFLICT],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ["2", "2"]